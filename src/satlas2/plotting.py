@@ -4,13 +4,14 @@ Functions for the generation of plots related to the fitting results.
 .. moduleauthor:: Wouter Gins <wouter.a.gins@jyu.fi>
 """
 import copy
+import gc
+import multiprocessing
+import pickle
 
 import h5py
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
-import uncertainties as u
-from scipy import optimize
 from scipy.stats import chi2
 import tqdm
 from .overwrite import SATLASHDFBackend
@@ -26,6 +27,11 @@ invcmap.set_under(inv_color_list[0])
 
 __all__ = ['generateChisquareMap', 'generateCorrelationPlot', 'generateWalkPlot']
 
+# 3, 2 and 1 sigma quantiles of the chisquare distribution with 1 degree
+# of freedom, used as fixed contour bounds in generateChisquareMap.
+_SIGMA_BOUNDS = np.concatenate(
+    [-chi2.ppf([0.997300204, 0.954499736, 0.682689492], 1), [0.0]])
+
 def _make_axes_grid(no_variables, padding=0, cbar_size=0.5, axis_padding=0.5, cbar=True):
     """Makes a triangular grid of axes, with a colorbar axis next to it.
 
@@ -45,84 +51,237 @@ def _make_axes_grid(no_variables, padding=0, cbar_size=0.5, axis_padding=0.5, cb
     fig, axes, cbar: tuple
         Tuple containing the figure, a 2D-array of axes and the colorbar axis."""
 
-    # Convert to inches.
-    padding, cbar_size, axis_padding = (padding * 0.393700787,
-                                        cbar_size * 0.393700787,
-                                        axis_padding * 0.393700787)
-    if not cbar:
-        cbar_size = 0
-
-    # Generate the figure, convert padding to percentages.
-    fig = plt.figure()
-    padding = 1
-
-    axis_size_left = (fig.get_figwidth()-padding - 0*(no_variables + 1) * padding) / no_variables
-    axis_size_up = (fig.get_figheight()-padding - 0*(no_variables + 1) * padding) / no_variables
-
-    cbar_size = cbar_size / fig.get_figwidth()
-    left_padding = padding * 0.5 / fig.get_figwidth()
-    left_axis_padding = axis_padding / fig.get_figwidth()
-    up_padding = padding * 0.5 / fig.get_figheight()
-    up_axis_padding = 0*axis_padding / fig.get_figheight()
-    axis_size_left = axis_size_left / fig.get_figwidth()
-    axis_size_up = axis_size_up / fig.get_figheight()
-
-    # Pre-allocate a 2D-array to hold the axes.
-    axes = np.array([[None for _ in range(no_variables)] for _ in range(no_variables)],
-                    dtype='object')
-
-    for i, I in zip(range(no_variables), reversed(range(no_variables))):
-        for j in reversed(range(no_variables)):
-            # Only create axes on the lower triangle.
-            if I + j < no_variables:
-                # Share the x-axis with the plot on the diagonal,
-                # directly above the plot.
-                sharex = axes[j, j] if i != j else None
-                # Share the y-axis among the 2D maps along one row,
-                # but not the plot on the diagonal!
-                sharey = axes[i, i-1] if (i != j and i-1 != j) else None
-                # Determine the place and size of the axes
-                left_edge = j * axis_size_left + left_padding
-                bottom_edge = I * axis_size_up + up_padding
-                if j > 0:
-                    left_edge += j * left_axis_padding
-                if I > 0:
-                    bottom_edge += I * up_axis_padding
-
-                a = plt.axes([left_edge, bottom_edge, axis_size_left, axis_size_up],
-                             sharex=sharex, sharey=sharey)
-                plt.setp(a.xaxis.get_majorticklabels(), rotation=45)
-                plt.setp(a.yaxis.get_majorticklabels(), rotation=45)
-            else:
-                a = None
-            if i == j:
-                a.yaxis.tick_right()
-                a.yaxis.set_label_position('right')
-            axes[i, j] = a
-
-    axes = np.array(axes)
-    for a in axes[:-1, :].flatten():
+    # Create the full square of axes in one batched call, sharing the
+    # x-axis of each column with the plot on the diagonal.
+    fig, axes = plt.subplots(no_variables, no_variables, sharex='col',
+                             squeeze=False,
+                             gridspec_kw={'hspace': 0, 'wspace': 0})
+
+    # Share the y-axis among the 2D maps along one row,
+    # but not with the plot on the diagonal!
+    for i in range(no_variables):
+        for j in range(1, i):
+            axes[i, j].sharey(axes[i, 0])
+
+    # Remember the corner positions for placing the colorbar axis, then
+    # remove the axes on the upper triangle.
+    corner = axes[0, -1].get_position()
+    bottom = axes[-1, -1].get_position()
+    for i in range(no_variables):
+        for j in range(i + 1, no_variables):
+            axes[i, j].remove()
+            axes[i, j] = None
+
+    for i in range(no_variables):
+        axes[i, i].yaxis.tick_right()
+        axes[i, i].yaxis.set_label_position('right')
+
+    for a in axes.flatten():
         if a is not None:
-            plt.setp(a.get_xticklabels(), visible=False)
+            plt.setp(a.xaxis.get_majorticklabels(), rotation=45)
+            plt.setp(a.yaxis.get_majorticklabels(), rotation=45)
+    # The shared x-axes already hide the inner x-ticklabels, the
+    # y-ticklabels outside of the first column are hidden here.
     for a in axes[:, 1:].flatten():
         if a is not None:
-            plt.setp(a.get_yticklabels(), visible=False)
-    left_edge = no_variables*(axis_size_left+left_axis_padding)+left_padding
-    bottom_edge = up_padding
-    width = cbar_size
-
-    height = axis_size_up * len(axes) + up_padding * (len(axes) - 1)
-
-    cbar_width = axis_size_left * 0.1
-    if cbar:
-        cbar = plt.axes([1-cbar_width-padding*0.5/fig.get_figwidth(), padding*0.5/fig.get_figheight()+axis_size_up*1.5, cbar_width, axis_size_up*(no_variables-1)-axis_size_up*0.5])
+            # Also hide the right-side labels the diagonal axes enable.
+            a.tick_params(labelleft=False, labelright=False)
+
+    if cbar and no_variables > 1:
+        cbar_width = corner.width * 0.1
+        cbar = fig.add_axes([corner.x1 - cbar_width,
+                             bottom.y1 + 0.5 * bottom.height,
+                             cbar_width,
+                             corner.y1 - bottom.y1 - 0.5 * bottom.height])
         plt.setp(cbar.get_xticklabels(), visible=False)
         plt.setp(cbar.get_yticklabels(), visible=False)
     else:
         cbar = None
     return fig, axes, cbar
 
-def generateChisquareMap(fitter, filter=None, method='chisquare', resolution_diag=15, resolution_map=15, fit_kws={}, source=False, model=True):
+def _formatUncertainty(value, err_down, err_up):
+    """Formats a value with asymmetric uncertainties, using two significant
+    digits on the uncertainty and switching to scientific notation for
+    large or small values.
+
+    Parameters
+    ----------
+    value: float
+        Central value.
+    err_down, err_up: float
+        Lower and upper uncertainty on the value.
+
+    Returns
+    -------
+    value_str, down_str, up_str, exponent: tuple
+        Formatted strings for the value and both uncertainties, plus the
+        base-10 exponent when scientific notation is needed, None
+        otherwise."""
+    err = max(abs(err_down), abs(err_up))
+    if not (np.isfinite(err) and err > 0):
+        return '{:g}'.format(value), '0', '0', None
+    exponent = int(np.floor(np.log10(np.abs(value)))) if value != 0 else 0
+    if abs(exponent) >= 4:
+        scale = 10.0 ** exponent
+        value, err_down, err_up, err = (value / scale, err_down / scale,
+                                        err_up / scale, err / scale)
+    else:
+        exponent = None
+    digits = max(1 - int(np.floor(np.log10(err))), 0)
+    fmt = '{{:.{}f}}'.format(digits)
+    return (fmt.format(value), fmt.format(abs(err_down)),
+            fmt.format(abs(err_up)), exponent)
+
+def _compose_labels(names, source, model, source_newline=False):
+    """Builds display labels from the source___model___parameter names.
+
+    Parameters
+    ----------
+    names: list of str
+        Full parameter names, as joined with triple underscores.
+    source: bool
+        Prepend the source name to the label.
+    model: bool
+        Prepend the model name to the label.
+    source_newline: bool
+        Put the source name on its own line.
+
+    Returns
+    -------
+    list of str
+        Display label for each parameter."""
+    splits = [name.split('___') for name in names]
+    parts = [[s[2] for s in splits]]
+    if model:
+        parts.insert(0, [s[1] for s in splits])
+    if source:
+        suffix = '\n' if source_newline else ''
+        parts.insert(0, [s[0] + suffix for s in splits])
+    return [' '.join(p) for p in zip(*parts)]
+
+def _percentile(x, q):
+    """Selects the given percentiles of *x* through np.partition, which is
+    O(N) instead of the full O(N log N) sort done by np.percentile. The
+    nearest-rank result differs from the interpolated percentile by at most
+    one sample, negligible for plot quantiles of MCMC-sized chains."""
+    q = np.atleast_1d(q)
+    k = (q / 100 * (x.size - 1)).astype(int)
+    return np.partition(x, k, axis=None)[k]
+
+def _centers_to_edges(centers):
+    """Converts an array of bin centers to the corresponding bin edges."""
+    return np.concatenate([[2 * centers[0] - centers[1]],
+                           0.5 * (centers[1:] + centers[:-1]),
+                           [2 * centers[-1] - centers[-2]]])
+
+def _read_chain(reader, selection):
+    """Reads the selected part of an MCMC chain as one contiguous slice.
+
+    Parameters
+    ----------
+    reader: :class:`.SATLASHDFBackend`
+        Backend pointing to the h5 file containing the data from the walk.
+    selection: tuple of float
+        Start and end percentage of the chain to read.
+
+    Returns
+    -------
+    data, first, last: tuple
+        Chain slice of shape (steps, walkers, parameters), along with the
+        indices of the first and last step that were read."""
+    try:
+        with h5py.File(reader.filename, 'r') as f:
+            g = f[reader.name]
+            dataset = g['chain']
+            iteration = g.attrs['iteration']
+            first = int(np.floor(iteration / 100 * selection[0]))
+            last = int(np.ceil(iteration / 100 * selection[1]))
+            # Stream the slab straight into a preallocated buffer, avoiding
+            # the intermediate array a normal slice read would create.
+            data = np.empty((last - first,) + dataset.shape[1:],
+                            dtype=dataset.dtype)
+            if last > first:
+                dataset.read_direct(data, source_sel=np.s_[first:last])
+    except KeyError:
+        data = reader.get_chain(flat=False)
+        dataset_length = data.shape[0]
+        first = int(np.floor(dataset_length / 100 * selection[0]))
+        last = int(np.ceil(dataset_length / 100 * selection[1]))
+        data = data[first:last, :, :]
+    return data, first, last
+
+def _eval_grid(fitter, params, names, x_range, y_range, orig_value, method, fit_kws):
+    """Evaluates the chisquare/likelihood difference on the grid spanned by
+    the two coordinate ranges, reusing a single Parameters instance so the
+    per-point work is limited to two value assignments and the fit itself.
+
+    Parameters
+    ----------
+    fitter: :class:`.Fitter`
+        Fitter instance used for the refits.
+    params: lmfit.Parameters
+        Parameters instance in which the two scanned parameters are mutated.
+    names: tuple of str
+        Names of the parameters mapped to the x and y values.
+    x_range, y_range: array_like
+        Grid coordinates along each axis.
+    orig_value: float
+        Best-fit chisquare or likelihood to subtract.
+    method: str
+        Fitting method, used to select the statistic that is extracted.
+    fit_kws: dictionary
+        Dictionary of keywords to pass on to the fitting routine.
+
+    Returns
+    -------
+    ndarray
+        Statistic differences with shape (len(y_range), len(x_range))."""
+    lmpar_x = params[names[0]]
+    lmpar_y = params[names[1]]
+    lmpar_x.vary = False
+    lmpar_y.vary = False
+    use_llh = method.lower().startswith('llh')
+    Z = np.zeros((len(y_range), len(x_range)))
+    if any(p.vary for p in params.values()):
+        for yi, y in enumerate(y_range):
+            lmpar_y.value = y
+            for xi, x in enumerate(x_range):
+                lmpar_x.value = x
+                fitter.lmpars = params
+                fitter.fit(prepFit=False, **fit_kws)
+                if use_llh:
+                    Z[yi, xi] = (fitter.llh_result - orig_value) * 2
+                else:
+                    Z[yi, xi] = fitter.chisqr - orig_value
+    else:
+        # With only the two scanned parameters free there is nothing left
+        # to optimize, and the scalar minimizers refuse zero-variable
+        # problems: evaluate the statistic directly instead of refitting.
+        fitter.temp_y = fitter.y()
+        llh_method = fit_kws.get('llh_method', 'gaussian')
+        for yi, y in enumerate(y_range):
+            lmpar_y.value = y
+            for xi, x in enumerate(x_range):
+                lmpar_x.value = x
+                if use_llh:
+                    Z[yi, xi] = (fitter.llh(params, method=llh_method) - orig_value) * 2
+                else:
+                    resid = fitter.optimizeFunc(params)
+                    Z[yi, xi] = np.sum(np.square(resid)) - orig_value
+        del fitter.temp_y
+    return Z
+
+def _tile(args):
+    """Computes one off-diagonal tile of the chisquare map. The argument
+    tuple matches what :func:`_eval_grid` needs, extended with the (i, j)
+    position of the tile so results can be matched up when the tiles are
+    computed in worker processes."""
+    fitter, params, names, i, j, x_range, y_range, orig_value, method, fit_kws = args
+    Z = _eval_grid(fitter, params, names, x_range, y_range,
+                   orig_value, method, fit_kws)
+    return i, j, Z
+
+def generateChisquareMap(fitter, filter=None, method='chisquare', resolution_diag=15, resolution_map=15, fit_kws={}, source=False, model=True, workers=1):
     """Generates a correlation map for either the chisquare or the MLE method.
     On the diagonal, the chisquare or loglikelihood is drawn as a function of one fixed parameter.
     Refitting to the data each time gives the points on the line. A dashed line is drawn on these
@@ -149,7 +308,13 @@ def generateChisquareMap(fitter, filter=None, method='chisquare', resolution_dia
         Dictionary of keywords to pass on to the fitting routine.
     npar: int
         Number of parameters for which simultaneous predictions need to be made.
-        Influences the uncertainty estimates from the parabola."""
+        Influences the uncertainty estimates from the parabola.
+    workers: int
+        Number of processes used to calculate the off-diagonal maps in
+        parallel. Requires the fitter to be picklable; the default of 1
+        keeps all calculations in the current process. The workers are
+        spawned, so calling scripts must be importable: guard the entry
+        point with ``if __name__ == '__main__'``."""
 
     title = '{}\n${}_{{-{}}}^{{+{}}}$'
     title_e = '{}\n$({}_{{-{}}}^{{+{}}})e{}$'
@@ -161,7 +326,14 @@ def generateChisquareMap(fitter, filter=None, method='chisquare', resolution_dia
         orig_value = fitter.chisqr
     if method.lower().startswith('llh'):
         orig_value = fitter.llh_result
-    result = copy.deepcopy(fitter.result)
+        # Select the likelihood path once, for every refit below; the copy
+        # also keeps the caller's dictionary unchanged.
+        fit_kws = {**fit_kws, 'llh_selected': True}
+    # Only the Parameters need a deep copy to restore the fit state at the
+    # end; the other result attributes, including the potentially large
+    # residual arrays, are not mutated by the scans below.
+    result = copy.copy(fitter.result)
+    result.params = copy.deepcopy(fitter.result.params)
     orig_params = copy.deepcopy(fitter.lmpars)
 
     ranges = {}
@@ -174,24 +346,17 @@ def generateChisquareMap(fitter, filter=None, method='chisquare', resolution_dia
             param_names.append(p)
     fig, axes, cbar = _make_axes_grid(no_params, axis_padding=0, cbar=no_params > 1)
 
-    split_names = [name.split('___') for name in param_names]
-    sources = [name[0] for name in split_names]
-    models = [name[1] for name in split_names]
-    var_names = [name[2] for name in split_names]
-    to_be_combined = [var_names]
-    if model:
-        to_be_combined.insert(0, models)
-    if source:
-        to_be_combined.insert(0, sources)
-
-    var_names = [' '.join(tbc) for tbc in zip(*to_be_combined)]
+    var_names = _compose_labels(param_names, source, model)
 
     # Make the plots on the diagonal: plot the chisquare/likelihood
     # for the best fitting values while setting one parameter to
     # a fixed value.
-    saved_params = copy.deepcopy(fitter.lmpars)
+    # A single working Parameters instance is reused for all scans: only
+    # the scanned parameters are mutated, and they are restored from a
+    # scalar snapshot instead of deepcopying the whole set per iteration.
+    params = copy.deepcopy(orig_params)
+    snapshot = {n: (orig_params[n].value, orig_params[n].vary) for n in orig_params}
     for i in range(no_params):
-        params = copy.deepcopy(saved_params)
         ranges[param_names[i]] = {}
 
         # Set the y-ticklabels.
@@ -202,7 +367,6 @@ def generateChisquareMap(fitter, filter=None, method='chisquare', resolution_dia
                 ax.set_ylabel(r'$\Delta\chi^2$')
             else:
                 ax.set_ylabel(r'$\Delta\mathcal{L}$')
-                fit_kws['llh_selected'] = True
 
         # Select starting point to determine error widths.
         value = orig_params[param_names[i]].value
@@ -236,21 +400,47 @@ def generateChisquareMap(fitter, filter=None, method='chisquare', resolution_dia
         ax.axvline(right, ls="dashed", color=c)
         ax.axvline(left, ls="dashed", color=c)
         ax.axvline(value, ls="dashed", color=c)
-        up = '{:.2ug}'.format(u.ufloat(value, stderr))
-        down = '{:.2ug}'.format(u.ufloat(value, stderr))
-        val = up.split('+/-')[0].split('(')[-1]
-        r = up.split('+/-')[1].split(')')[0]
-        l = down.split('+/-')[1].split(')')[0]
-        if 'e' in up or 'e' in down:
-            ex = up.split('e')[-1]
+        val, l, r, ex = _formatUncertainty(value, stderr, stderr)
+        if ex is not None:
             ax.set_title(title_e.format(var_names[i], val, l, r, ex))
         else:
             ax.set_title(title.format(var_names[i], val, l, r))
-        # Restore the parameters.
-        fitter.lmpars = orig_params
+        # Restore the scanned parameter.
+        params[param_names[i]].value, params[param_names[i]].vary = snapshot[param_names[i]]
 
+    bounds = _SIGMA_BOUNDS
+    norm = mpl.colors.BoundaryNorm(bounds, invcmap.N)
+    tiles = []
     for i, j in zip(*np.tril_indices_from(axes, -1)):
-        params = copy.deepcopy(orig_params)
+        x_name = param_names[j]
+        y_name = param_names[i]
+        x_range = np.linspace(ranges[x_name]['left_val'],
+                              ranges[x_name]['right_val'], resolution_map)
+        y_range = np.linspace(ranges[y_name]['left_val'],
+                              ranges[y_name]['right_val'], resolution_map)
+        tiles.append((i, j, x_range, y_range))
+
+    # The tiles are independent refit problems, so they can be handed to
+    # worker processes, each receiving its own pickled copy of the fitter.
+    # Plotting stays in this process.
+    results = None
+    if workers > 1 and len(tiles) > 1:
+        args = [(fitter, params, (param_names[j], param_names[i]), i, j,
+                 x_range, y_range, orig_value, method, fit_kws)
+                for i, j, x_range, y_range in tiles]
+        # Verify everything pickles before creating the pool: a pool that
+        # is fed unpicklable tasks keeps respawning crashing workers and
+        # hangs instead of raising. Unpicklable input falls back to serial.
+        try:
+            pickle.dumps(args)
+            picklable = True
+        except (pickle.PicklingError, TypeError, AttributeError):
+            picklable = False
+        if picklable:
+            with multiprocessing.get_context('spawn').Pool(workers) as pool:
+                results = {(i, j): Z for i, j, Z in pool.imap_unordered(_tile, args)}
+
+    for i, j, x_range, y_range in tiles:
         ax = axes[i, j]
         x_name = param_names[j]
         y_name = param_names[i]
@@ -258,56 +448,41 @@ def generateChisquareMap(fitter, filter=None, method='chisquare', resolution_dia
             ax.set_ylabel(var_names[i])
         if i == no_params - 1:
             ax.set_xlabel(var_names[j])
-        right = ranges[x_name]['right_val']
-        left = ranges[x_name]['left_val']
-        x_range = np.linspace(left, right, resolution_map)
-
-        right = ranges[y_name]['right_val']
-        left = ranges[y_name]['left_val']
-        y_range = np.linspace(left, right, resolution_map)
 
-        X, Y = np.meshgrid(x_range, y_range)
-        Z = np.zeros(X.shape)
-        i_indices, j_indices = np.indices(Z.shape)
-        params[param_names[i]].vary = False
-        params[param_names[j]].vary = False
-
-        for k, l in zip(i_indices.flatten(), j_indices.flatten()):
-            x = X[k, l]
-            y = Y[k, l]
-            params[param_names[j]].value = x
-            params[param_names[i]].value = y
-            fitter.lmpars = params
-            fitter.fit(prepFit=False, **fit_kws)
-            if fitter.llh_result is not None:
-                Z[k, l] = (fitter.llh_result - orig_value)*2
-            else:
-                Z[k, l] = fitter.chisqr - orig_value
+        if results is not None:
+            Z = results[i, j]
+        else:
+            _, _, Z = _tile((fitter, params, (x_name, y_name), i, j,
+                             x_range, y_range, orig_value, method, fit_kws))
+            # Restore the two scanned parameters.
+            params[x_name].value, params[x_name].vary = snapshot[x_name]
+            params[y_name].value, params[y_name].vary = snapshot[y_name]
 
         Z = -Z
-        bounds = []
-        for bound in [0.997300204, 0.954499736, 0.682689492]:
-            chifunc = lambda x: chi2.cdf(x, 1) - bound # Calculate 1 sigma boundary
-            bounds.append(-optimize.root(chifunc, 1).x[0])
-        bounds.append(0)
-        bounds = np.array(bounds)
-        norm = mpl.colors.BoundaryNorm(bounds, invcmap.N)
-        contourset = ax.contourf(X, Y, Z, bounds, cmap=invcmap, norm=norm)
-        fitter.lmpars = copy.deepcopy(orig_params)
-    try:
+        # Draw the regular grid directly as a rasterized mesh, masking the
+        # cells outside of the 3-sigma bound that contourf left unfilled.
+        contourset = ax.pcolormesh(_centers_to_edges(x_range),
+                                   _centers_to_edges(y_range),
+                                   np.ma.masked_outside(Z, bounds[0], bounds[-1]),
+                                   cmap=invcmap, norm=norm, rasterized=True)
+    # With a single parameter there are no off-diagonal tiles and no
+    # colorbar axis, so only build the colorbar when one exists.
+    if cbar is not None and no_params > 1:
         cbar = plt.colorbar(contourset, cax=cbar, orientation='vertical')
         cbar.ax.yaxis.set_ticks([-7.5, -4.5, -1.5])
         cbar.ax.set_yticklabels([r'3$\sigma$', r'2$\sigma$', r'1$\sigma$'])
-    except:
-        pass
+    else:
+        cbar = None
     for a in axes.flatten():
         if a is not None:
-            for label in a.get_xticklabels()[::2]:
-                label.set_visible(False)
-            for label in a.get_yticklabels()[::2]:
-                label.set_visible(False)
+            plt.setp(a.get_xticklabels()[::2], visible=False)
+            plt.setp(a.get_yticklabels()[::2], visible=False)
     fitter.result = result
     fitter.updateInfo()
+    # Drop the per-tile grids before returning so batch callers do not
+    # accumulate them across calls.
+    del tiles, results
+    gc.collect()
     return fig, axes, cbar
 
 def generateCorrelationPlot(filename, filter=None, bins=None, selection=(0, 100), source=False, model=True):
@@ -328,30 +503,23 @@ def generateCorrelationPlot(filename, filter=None, bins=None, selection=(0, 100)
     Returns
     -------
     figure
-        Returns the MatPlotLib figure created."""
+        Returns the MatPlotLib figure created. The figure is not closed:
+        callers looping over many files should call :func:`plt.close` on
+        it when done."""
 
     reader = SATLASHDFBackend(filename)
-    var_names = list(reader.labels)
-    split_names = [name.split('___') for name in var_names]
-    sources = [name[0]+'\n' for name in split_names]
-    models = [name[1] for name in split_names]
-    var_names = [name[2] for name in split_names]
-    to_be_combined = [var_names]
-    if model:
-        to_be_combined.insert(0, models)
-    if source:
-        to_be_combined.insert(0, sources)
-
-    var_names = [' '.join(tbc) for tbc in zip(*to_be_combined)]
+    var_names = _compose_labels(list(reader.labels), source, model,
+                                source_newline=True)
 
-    data = reader.get_chain(flat=False)
-    dataset_length = data.shape[0]
-    first, last = int(np.floor(dataset_length/100*selection[0])), int(np.ceil(dataset_length/100*selection[1]))
-    data = data[first:last, :, :]
+    data, first, last = _read_chain(reader, selection)
     data = data.reshape(-1, data.shape[-1])
+    # Histogramming with at most a few hundred bins does not benefit from
+    # float64, so halve the memory bandwidth over the chain.
+    data = data.astype(np.float32, copy=False)
 
+    name_to_idx = {n: i for i, n in enumerate(var_names)}
     if filter is not None:
-        filter = [c for f in filter for c in var_names if f in c]
+        filter = [n for n in var_names if any(f in n for f in filter)]
     else:
         filter = var_names
     with tqdm.tqdm(total=len(filter)+(len(filter)**2-len(filter))/2, leave=True) as pbar:
@@ -364,33 +532,33 @@ def generateCorrelationPlot(filename, filter=None, bins=None, selection=(0, 100)
             pbar.set_description(val)
             ax = axes[i, i]
             bin_index = i
-            i = var_names.index(val)
+            i = name_to_idx[val]
             x = data[:, i]
 
             if bins[bin_index] is None:
                 width = 3.5*np.std(x)/x.size**(1/3) #Scott's rule for binwidth
-                bins[bin_index] = np.arange(x.min(), x.max()+width, width)
-            try:
-                n, b, p, = ax.hist(x, int(bins[bin_index]), histtype='step', color='k')
-            except TypeError:
-                bins[bin_index] = 50
-                n, b, p, = ax.hist(x, int(bins[bin_index]), histtype='step', color='k')
+                bins[bin_index] = max(int(np.ceil((x.max() - x.min()) / width)), 1)
+            nbins = int(bins[bin_index])
+            # Digitize the column once: both the diagonal histogram and the
+            # pair histograms below are built from these indices instead of
+            # letting ax.hist and np.histogram2d rescan the chain.
+            edges = np.linspace(x.min(), x.max(), nbins + 1)
+            digit = np.clip(np.searchsorted(edges, x, side='right') - 1, 0,
+                            nbins - 1)
+            n = np.bincount(digit, minlength=nbins)
+            ax.stairs(n, edges, color='k')
             # center = n.argmax()
-            # q50 = (b[center] + b[center+1])/2
+            # q50 = (edges[center] + edges[center+1])/2
             q = [15.87, 50, 84.13]
-            q16, q50, q84 = np.percentile(x, q)
-            metadata[val] = {'bins': bins[bin_index], 'min': x.min(), 'max': x.max()}
+            q16, q50, q84 = _percentile(x, q)
+            metadata[val] = {'bins': nbins, 'min': x.min(), 'max': x.max(),
+                             'edges': edges, 'digit': digit}
 
 
             title = '{}\n${}_{{-{}}}^{{+{}}}$'
             title_e = '{}\n$({}_{{-{}}}^{{+{}}})e{}$'
-            up = '{:.2ug}'.format(u.ufloat(q50, np.abs(q84-q50)))
-            down = '{:.2ug}'.format(u.ufloat(q50, np.abs(q50-q16)))
-            param_val = up.split('+/-')[0].split('(')[-1]
-            r = up.split('+/-')[1].split(')')[0]
-            l = down.split('+/-')[1].split(')')[0]
-            if 'e' in up or 'e' in down:
-                ex = up.split('e')[-1]
+            param_val, l, r, ex = _formatUncertainty(q50, q50 - q16, q84 - q50)
+            if ex is not None:
                 ax.set_title(title_e.format(val, param_val, l, r, ex))
             else:
                 ax.set_title(title.format(val, param_val, l, r))
@@ -403,6 +571,13 @@ def generateCorrelationPlot(filename, filter=None, bins=None, selection=(0, 100)
             ax.set_yticklabels([])
             pbar.update(1)
 
+        # The sigma regions are drawn from the cumulative probability mass:
+        # every bin is assigned the summed fraction of all bins at least as
+        # dense, making the level bounds, and therefore the norm, identical
+        # for every pair.
+        levels = 1.0 - np.exp(-0.5 * np.arange(1, 3.1, 1) ** 2)
+        bounds = np.concatenate([-levels[::-1], [0.0]])
+        norm = mpl.colors.BoundaryNorm(bounds, invcmap.N)
         for i, j in zip(*np.tril_indices_from(axes, -1)):
             x_name = filter[j]
             y_name = filter[i]
@@ -412,44 +587,40 @@ def generateCorrelationPlot(filename, filter=None, bins=None, selection=(0, 100)
                 ax.set_ylabel(filter[i])
             if i == len(filter) - 1:
                 ax.set_xlabel(filter[j])
-            j = var_names.index(x_name)
-            i = var_names.index(y_name)
-            x = data[:, j]
-            y = data[:, i]
-            x_min, x_max, x_bins = metadata[x_name]['min'], metadata[x_name]['max'], metadata[x_name]['bins']
-            y_min, y_max, y_bins = metadata[y_name]['min'], metadata[y_name]['max'], metadata[y_name]['bins']
-            X = np.linspace(x_min, x_max, x_bins + 1)
-            Y = np.linspace(y_min, y_max, y_bins + 1)
-            H, X, Y = np.histogram2d(x.flatten(), y.flatten(), bins=(X, Y),
-                                     weights=None)
-            X1, Y1 = 0.5 * (X[1:] + X[:-1]), 0.5 * (Y[1:] + Y[:-1])
-            X, Y = X[:-1], Y[:-1]
-            H = (H - H.min()) / (H.max() - H.min())
+            x_bins = int(metadata[x_name]['bins'])
+            y_bins = int(metadata[y_name]['bins'])
+            X = metadata[x_name]['edges']
+            Y = metadata[y_name]['edges']
+            # One np.bincount over the precomputed bin indices replaces the
+            # np.histogram2d pass over the full chain for this pair.
+            H = np.bincount(metadata[x_name]['digit'] * y_bins + metadata[y_name]['digit'],
+                            minlength=x_bins * y_bins).reshape(x_bins, y_bins)
 
             Hflat = H.flatten()
             inds = np.argsort(Hflat)[::-1]
-            Hflat = Hflat[inds]
-            sm = np.cumsum(Hflat)
-            sm /= sm[-1]
-            levels = 1.0 - np.exp(-0.5 * np.arange(1, 3.1, 1) ** 2)
-            V = np.empty(len(levels))
-            for i, v0 in enumerate(levels):
-                try:
-                    V[i] = Hflat[sm <= v0][-1]
-                except:
-                    V[i] = Hflat[0]
-
-            bounds = np.unique(np.concatenate([[H.max()], V])[::-1])
-            norm = mpl.colors.BoundaryNorm(bounds, invcmap.N)
-
-            contourset = ax.contourf(X1, Y1, H.T, bounds, cmap=invcmap, norm=norm)
+            sm = np.cumsum(Hflat[inds])
+            sm = sm / sm[-1]
+            R = np.empty_like(sm)
+            R[inds] = -sm
+            R = R.reshape(H.shape)
+
+            # Draw the rank image directly on its bin edges as a rasterized
+            # mesh, masking the cells outside of the 3-sigma bound.
+            contourset = ax.pcolormesh(X, Y,
+                                       np.ma.masked_outside(R.T, bounds[0], bounds[-1]),
+                                       cmap=invcmap, norm=norm, rasterized=True)
             pbar.update(1)
-        try:
+        # The colorbar axis only exists when there are off-diagonal tiles.
+        if cbar is not None and len(filter) > 1:
             cbar = plt.colorbar(contourset, cax=cbar, orientation='vertical')
-            cbar.ax.yaxis.set_ticks([0, 1/6, 0.5, 5/6])
-            cbar.ax.set_yticklabels(['', r'3$\sigma$', r'2$\sigma$', r'1$\sigma$'])
-        except:
+            cbar.ax.yaxis.set_ticks(0.5 * (bounds[:-1] + bounds[1:]))
+            cbar.ax.set_yticklabels([r'3$\sigma$', r'2$\sigma$', r'1$\sigma$'])
+        else:
             cbar = None
+    # The chain and the per-column bin indices scale with the number of
+    # samples; release them before returning.
+    del data, metadata
+    gc.collect()
     return fig, axes, cbar
 
 def generateWalkPlot(filename, filter=None, selection=(0, 100), walkers=20, source=False, model=True):
@@ -466,30 +637,18 @@ def generateWalkPlot(filename, filter=None, selection=(0, 100), walkers=20, sour
     Returns
     -------
     figure
-        Returns the MatPlotLib figure created."""
+        Returns the MatPlotLib figure created. The figure is not closed:
+        callers looping over many files should call :func:`plt.close` on
+        it when done."""
 
     reader = SATLASHDFBackend(filename)
-    var_names = reader.labels
-    split_names = [name.split('___') for name in var_names]
-    sources = [name[0] for name in split_names]
-    models = [name[1] for name in split_names]
-    var_names = [name[2] for name in split_names]
-    to_be_combined = [var_names]
-    if model:
-        to_be_combined.insert(0, models)
-    if source:
-        to_be_combined.insert(0, sources)
-
-    var_names = [' '.join(tbc) for tbc in zip(*to_be_combined)]
+    var_names = _compose_labels(list(reader.labels), source, model)
 
-    data = reader.get_chain(flat=False)
-    dataset_length = data.shape[0]
-    first, last = int(np.floor(dataset_length/100*selection[0])), int(np.ceil(dataset_length/100*selection[1]))
-    data = data[first:last, :, :]
-    # data = data.reshape(-1, data.shape[-1])
+    data, first, last = _read_chain(reader, selection)
 
+    name_to_idx = {n: i for i, n in enumerate(var_names)}
     if filter is not None:
-        filter = [c for f in filter for c in var_names if f in c]
+        filter = [n for n in var_names if any(f in n for f in filter)]
     else:
         filter = var_names
     with tqdm.tqdm(total=len(filter), leave=True) as pbar:
@@ -497,13 +656,15 @@ def generateWalkPlot(filename, filter=None, selection=(0, 100), walkers=20, sour
 
         for i, (val, ax) in enumerate(zip(filter, axes)):
             pbar.set_description(val)
-            i = var_names.index(val)
+            i = name_to_idx[val]
             x = data[:, :, i]
-            q50 = np.percentile(x, [50.0])
+            q50 = _percentile(x, [50.0])
             ax.plot(range(first, last), x, alpha=0.3, color='gray')
             ax.set_ylabel(val)
             ax.axhline(q50, color='k')
             pbar.update(1)
         ax.set_xlabel('Step')
     pbar.close()
+    del data
+    gc.collect()
     return fig, axes